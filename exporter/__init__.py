@@ -27,6 +27,10 @@ from .node_writer import NodeWriter
 from ..utils.constants import KN5_HEADER_BYTES
 
 
+# Large enough that the many small header and node writes are coalesced into few syscalls
+OUTPUT_BUFFER_SIZE = 2**20
+
+
 class ReportOperator(bpy.types.Operator):
     bl_idname = "kn5.report_message"
     bl_label = "Export report"
@@ -112,7 +116,7 @@ class ExportKN5(bpy.types.Operator, ExportHelper):
     def execute(self, context):
         warnings = []
         try:
-            output_file = open(self.filepath, "wb")
+            output_file = open(self.filepath, "wb", buffering=OUTPUT_BUFFER_SIZE)
             try:
                 settings = read_settings(self.filepath)
                 kn5_writer = KN5FileWriter(output_file, context, settings, warnings)
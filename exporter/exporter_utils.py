@@ -14,21 +14,38 @@
 # Copyright (C) 2014  Thomas Hagnhofer
 
 
-import json
+import functools
 import os
 import bpy
+import numpy as np
 from mathutils import Matrix, Quaternion, Vector
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# Applies the same axis swap as convert_vector3 when multiplied with a (homogeneous) vector
+AXIS_CONVERSION = np.array((
+    (1.0, 0.0, 0.0, 0.0),
+    (0.0, 0.0, 1.0, 0.0),
+    (0.0, -1.0, 0.0, 0.0),
+    (0.0, 0.0, 0.0, 1.0),
+), dtype=np.float32)
 
 def convert_matrix(in_matrix):
-    co, rotation, scale = in_matrix.decompose()
+    matrix_rows = tuple(tuple(row) for row in in_matrix)
+    return _convert_matrix_rows(matrix_rows).copy()
+
+
+@functools.lru_cache(maxsize=1024)
+def _convert_matrix_rows(matrix_rows):
+    co, rotation, scale = Matrix(matrix_rows).decompose()
     co = convert_vector3(co)
     rotation = convert_quaternion(rotation)
     mat_loc = Matrix.Translation(co)
-    mat_scale_1 = Matrix.Scale(scale[0], 4, (1, 0, 0))
-    mat_scale_2 = Matrix.Scale(scale[2], 4, (0, 1, 0))
-    mat_scale_3 = Matrix.Scale(scale[1], 4, (0, 0, 1))
-    mat_scale = mat_scale_1 @ mat_scale_2 @ mat_scale_3
+    mat_scale = Matrix.Diagonal((scale[0], scale[2], scale[1], 1.0))
     mat_rot = rotation.to_matrix().to_4x4()
     return mat_loc @ mat_rot @ mat_scale
 
@@ -43,6 +60,21 @@ def convert_quaternion(in_quat):
     return Quaternion(axis, angle)
 
 
+def get_collection_array(collection, attribute, size, dtype=np.float32):
+    values = np.empty(len(collection) * size, dtype=dtype)
+    collection.foreach_get(attribute, values)
+    return values.reshape(-1, size)
+
+
+def unique_in_order(values):
+    """Like np.unique, but orders unique values by their first occurrence rather than by value."""
+    _, first_indices, inverse = np.unique(values, return_index=True, return_inverse=True)
+    order = np.argsort(first_indices)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return first_indices[order], ranks[inverse.ravel()]
+
+
 def get_texture_nodes(material):
     texture_nodes = []
     if material.node_tree:
@@ -77,4 +109,12 @@ def read_settings(file):
     settings_path = os.path.join(dir_name, "settings.json")
     if not os.path.exists(settings_path):
         return {}
-    return json.loads(open(settings_path, "r").read())
+    stat = os.stat(settings_path)
+    return _load_settings(settings_path, stat.st_mtime_ns, stat.st_size)
+
+
+# Also keyed on modification time and size, so edited settings files are reloaded
+@functools.lru_cache(maxsize=8)
+def _load_settings(settings_path, _modified_time, _size):
+    with open(settings_path, "rb") as settings_file:
+        return json_loads(settings_file.read())
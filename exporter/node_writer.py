@@ -17,11 +17,14 @@
 import os
 import re
 import bmesh
+import numpy as np
 from mathutils import Matrix
 from .exporter_utils import (
+    AXIS_CONVERSION,
     convert_matrix,
-    convert_vector3,
     get_active_material_texture_slot,
+    get_collection_array,
+    unique_in_order,
 )
 from .kn5_writer import KN5Writer
 from ..utils.constants import ASSETTO_CORSA_OBJECTS
@@ -29,6 +32,8 @@ from ..utils.constants import ASSETTO_CORSA_OBJECTS
 
 NODES = "nodes"
 
+ASSETTO_CORSA_OBJECTS_REGEX = re.compile(f"^(?:{'|'.join(ASSETTO_CORSA_OBJECTS)})$")
+
 NODE_CLASS = {
     "Node" : 1,
     "Mesh" : 2,
@@ -45,6 +50,14 @@ NODE_SETTINGS = (
     "renderable",
 )
 
+# Matches the KN5 vertex layout, so a vertex array can be written out as-is
+VERTEX_DTYPE = np.dtype([
+    ("co", "<f4", 3),
+    ("normal", "<f4", 3),
+    ("uv", "<f4", 2),
+    ("tangent", "<f4", 3),
+])
+
 
 class NodeWriter(KN5Writer):
     def __init__(self, file, context, settings, warnings, material_writer):
@@ -56,8 +69,7 @@ class NodeWriter(KN5Writer):
         self.material_writer = material_writer
         self.scene = self.context.scene
         self.node_settings = []
-        self.ac_objects = []
-        self._init_assetto_corsa_objects()
+        self._has_mesh_children = {}
         self._init_node_settings()
 
     def _init_node_settings(self):
@@ -66,57 +78,52 @@ class NodeWriter(KN5Writer):
             for node_key in self.settings[NODES]:
                 self.node_settings.append(NodeSettings(self.settings, node_key))
 
-    def _init_assetto_corsa_objects(self):
-        for obj_name in ASSETTO_CORSA_OBJECTS:
-            self.ac_objects.append(re.compile(f"^{obj_name}$"))
-
     def _is_ac_object(self, name):
-        for regex in self.ac_objects:
-            if regex.match(name):
-                return True
-        return False
+        return ASSETTO_CORSA_OBJECTS_REGEX.match(name) is not None
 
     def write(self):
-        self._write_base_node(None, "BlenderFile")
-        for obj in sorted(self.context.blend_data.objects, key=lambda k: len(k.children)):
-            if not obj.parent:
-                self._write_object(obj)
+        root_objects = [
+            obj for obj in self.context.blend_data.objects
+            if not obj.parent and not obj.name.startswith("__")
+        ]
+        root_objects.sort(key=lambda k: len(k.children))
+        self._write_base_node(None, "BlenderFile", len(root_objects))
+        for obj in root_objects:
+            self._write_object(obj)
 
     def _write_object(self, obj):
-        if not obj.name.startswith("__"):
-            if obj.type == "MESH":
-                if obj.children:
-                    raise Exception(f"A mesh cannot contain children ('{obj.name}')")
-                self._write_mesh_node(obj)
-            else:
-                self._write_base_node(obj, obj.name)
-            for child in obj.children:
+        if obj.type == "MESH":
+            if obj.children:
+                raise Exception(f"A mesh cannot contain children ('{obj.name}')")
+            self._write_mesh_node(obj)
+        else:
+            children = [child for child in obj.children if not child.name.startswith("__")]
+            self._write_base_node(obj, obj.name, len(children))
+            for child in children:
                 self._write_object(child)
 
     def _any_child_is_mesh(self, obj):
-        for child in obj.children:
-            if child.type in ["MESH", "CURVE"] or self._any_child_is_mesh(child):
-                return True
-        return False
+        pointer = obj.as_pointer()
+        has_mesh = self._has_mesh_children.get(pointer)
+        if has_mesh is None:
+            has_mesh = any(
+                child.type in ["MESH", "CURVE"] or self._any_child_is_mesh(child)
+                for child in obj.children
+            )
+            self._has_mesh_children[pointer] = has_mesh
+        return has_mesh
 
-    def _write_base_node(self, obj, node_name):
+    def _write_base_node(self, obj, node_name, num_children):
         node_data = {}
         matrix = None
-        num_children = 0
         if not obj:
             matrix = Matrix()
-            for obj in self.context.blend_data.objects:
-                if not obj.parent and not obj.name.startswith("__"):
-                    num_children += 1
         else:
             if not self._is_ac_object(obj.name) and not self._any_child_is_mesh(obj):
                 msg = f"Unknown logical object '{obj.name}' might prevent other objects from loading.{os.linesep}"
                 msg += "\tRename it to '__{obj.name}' if you do not want to export it."
                 self.warnings.append(msg)
             matrix = convert_matrix(obj.matrix_local)
-            for child in obj.children:
-                if not child.name.startswith("__"):
-                    num_children += 1
 
         node_data["name"] = node_name
         node_data["childCount"] = num_children
@@ -165,14 +172,9 @@ class NodeWriter(KN5Writer):
         if len(mesh.vertices) > 2**16:
             raise Exception(f"Only {2**16} vertices per mesh allowed. ('{obj.name}')")
         self.write_uint(len(mesh.vertices))
-        for vertex in mesh.vertices:
-            self.write_vector3(vertex.co)
-            self.write_vector3(vertex.normal)
-            self.write_vector2(vertex.uv)
-            self.write_vector3(vertex.tangent)
+        self.file.write(mesh.vertices.tobytes())
         self.write_uint(len(mesh.indices))
-        for i in mesh.indices:
-            self.write_ushort(i)
+        self.file.write(np.asarray(mesh.indices, dtype="<u2").tobytes())
         if mesh.material_id is None:
             self.warnings.append(f"No material to mesh '{obj.name}' assigned")
             self.write_uint(0)
@@ -181,37 +183,14 @@ class NodeWriter(KN5Writer):
         self.write_uint(node_properties.layer) #Layer
         self.write_float(node_properties.lodIn) #LOD In
         self.write_float(node_properties.lodOut) #LOD Out
-        self._write_bounding_sphere(mesh.vertices)
+        self._write_bounding_sphere(mesh.vertices.co)
         self.write_bool(node_properties.renderable) #isRenderable
 
-    def _write_bounding_sphere(self, vertices):
-        max_x = -999999999
-        max_y = -999999999
-        max_z = -999999999
-        min_x = 999999999
-        min_y = 999999999
-        min_z = 999999999
-        for vertex in vertices:
-            co = vertex.co
-            if co[0] > max_x:
-                max_x = co[0]
-            if co[0] < min_x:
-                min_x = co[0]
-            if co[1] > max_y:
-                max_y = co[1]
-            if co[1] < min_y:
-                min_y = co[1]
-            if co[2] > max_z:
-                max_z = co[2]
-            if co[2] < min_z:
-                min_z = co[2]
-
-        sphere_center = [
-            min_x + (max_x - min_x) / 2,
-            min_y + (max_y - min_y) / 2,
-            min_z + (max_z - min_z) / 2
-        ]
-        sphere_radius = max((max_x - min_x) / 2, (max_y - min_y) / 2, (max_z - min_z) / 2) * 2
+    def _write_bounding_sphere(self, positions):
+        min_co = positions.min(axis=0)
+        max_co = positions.max(axis=0)
+        sphere_center = (min_co + max_co) / 2
+        sphere_radius = float((max_co - min_co).max())
         self.write_vector3(sphere_center)
         self.write_float(sphere_radius)
 
@@ -228,16 +207,26 @@ class NodeWriter(KN5Writer):
         try:
             mesh_copy.calc_loop_triangles()
             mesh_copy.calc_tangents()
-            mesh_vertices = mesh_copy.vertices[:]
-            mesh_loops = mesh_copy.loops[:]
-            mesh_triangles = mesh_copy.loop_triangles[:]
             uv_layer = mesh_copy.uv_layers.active
-            matrix = obj.matrix_world
 
             if not mesh_copy.materials:
                 raise Exception(f"Object '{obj.name}' has no material assigned")
 
-            used_materials = set([triangle.material_index for triangle in mesh_triangles])
+            matrix = AXIS_CONVERSION @ np.array(obj.matrix_world, dtype=np.float32)
+            vertex_positions = get_collection_array(mesh_copy.vertices, "co", 3)
+            converted_positions = vertex_positions @ matrix[:3, :3].T + matrix[:3, 3]
+
+            loop_vertex_indices = get_collection_array(mesh_copy.loops, "vertex_index", 1, np.int32).ravel()
+            loop_normals = get_collection_array(mesh_copy.loops, "normal", 3) @ AXIS_CONVERSION[:3, :3].T
+            loop_tangents = get_collection_array(mesh_copy.loops, "tangent", 3)
+            loop_uvs = None
+            if uv_layer:
+                loop_uvs = get_collection_array(uv_layer.data, "uv", 2)
+                loop_uvs[:, 1] *= -1
+            triangle_loops = get_collection_array(mesh_copy.loop_triangles, "loops", 3, np.int32)
+            triangle_materials = get_collection_array(mesh_copy.loop_triangles, "material_index", 1, np.int32).ravel()
+
+            used_materials = np.unique(triangle_materials).tolist()
             for material_index in used_materials:
                 if not mesh_copy.materials[material_index]:
                     raise Exception(f"Material slot {material_index} for object '{obj.name}' has no material assigned")
@@ -245,81 +234,74 @@ class NodeWriter(KN5Writer):
                 if material_name.startswith("__"):
                     raise Exception(f"Material '{material_name}' is ignored but is used by object '{obj.name}'")
 
-                vertices = {}
-                indices = []
-                for triangle in mesh_triangles:
-                    if material_index != triangle.material_index:
-                        continue
-                    vertex_index_for_face = 0
-                    face_indices = []
-                    for loop_index in triangle.loops:
-                        loop = mesh_loops[loop_index]
-                        local_position = matrix @ mesh_vertices[loop.vertex_index].co
-                        converted_position = convert_vector3(local_position)
-                        converted_normal = convert_vector3(loop.normal)
-                        uv = (0, 0)
-                        if uv_layer:
-                            uv = uv_layer.data[loop_index].uv
-                            uv = (uv[0], -uv[1])
-                        else:
-                            uv = self._calculate_uvs(obj, mesh_copy, material_index, local_position)
-                        tangent = loop.tangent
-                        vertex = UvVertex(converted_position, converted_normal, uv, tangent)
-                        if vertex not in vertices:
-                            new_index = len(vertices)
-                            vertices[vertex] = new_index
-                        face_indices.append(vertices[vertex])
-                        vertex_index_for_face += 1
-                    indices.extend((face_indices[1], face_indices[2], face_indices[0]))
-                    if len(face_indices) == 4:
-                        indices.extend((face_indices[2], face_indices[3], face_indices[0]))
-                vertices = [v for v, index in sorted(vertices.items(), key=lambda k: k[1])]
+                corner_loops = triangle_loops[triangle_materials == material_index].ravel()
+                corner_vertex_indices = loop_vertex_indices[corner_loops]
+                corners = np.empty(len(corner_loops), dtype=VERTEX_DTYPE)
+                corners["co"] = converted_positions[corner_vertex_indices]
+                corners["normal"] = loop_normals[corner_loops]
+                if loop_uvs is not None:
+                    corners["uv"] = loop_uvs[corner_loops]
+                else:
+                    # World space XY, before the axis conversion
+                    world_positions = corners["co"][:, (0, 2)] * (1, -1)
+                    corners["uv"] = self._calculate_uvs(obj, mesh_copy, material_index, world_positions)
+                corners["tangent"] = loop_tangents[corner_loops]
+
+                vertices, corner_indices = self._deduplicate_vertices(corners)
+                # Triangles are wound (1, 2, 0) in KN5
+                indices = corner_indices.reshape(-1, 3)[:, (1, 2, 0)].ravel()
                 material_id = self.material_writer.material_positions[material_name]
                 meshes.append(Mesh(material_id, vertices, indices))
         finally:
             obj.to_mesh_clear()
         return meshes
 
+    @staticmethod
+    def _deduplicate_vertices(corners):
+        # Rows are compared bytewise, so fold -0.0 into 0.0 to keep them equal as floats
+        corners.view(np.float32)[:] += 0.0
+        packed_rows = corners.view(np.dtype((np.void, VERTEX_DTYPE.itemsize)))
+        unique_indices, inverse = unique_in_order(packed_rows)
+        return corners[unique_indices].view(np.recarray), inverse
+
     def _split_meshes_for_vertex_limit(self, divided_meshes):
-        new_meshes = []
         limit = 2**16
+        if all(len(mesh.vertices) <= limit for mesh in divided_meshes):
+            return divided_meshes
+        new_meshes = []
         for mesh in divided_meshes:
             if len(mesh.vertices) > limit:
-                start_index = 0
-                while start_index < len(mesh.indices):
-                    vertex_index_mapping = {}
-                    new_indices = []
-                    for i in range(start_index, len(mesh.indices), 3):
-                        start_index += 3
-                        face = mesh.indices[i:i+3]
-                        for face_index in face:
-                            if not face_index in vertex_index_mapping:
-                                new_index = len(vertex_index_mapping)
-                                vertex_index_mapping[face_index] = new_index
-                            new_indices.append(vertex_index_mapping[face_index])
-                        if len(vertex_index_mapping) >= limit-3:
-                            break
-                    verts = [mesh.vertices[v] for v, index in sorted(vertex_index_mapping.items(), key=lambda k: k[1])]
-                    new_meshes.append(Mesh(mesh.material_id, verts, new_indices))
+                triangles = np.asarray(mesh.indices).reshape(-1, 3)
+                while len(triangles):
+                    # Take triangles until they reference close to the limit of distinct vertices
+                    _, first_corners = np.unique(triangles, return_index=True)
+                    vertex_counts = np.cumsum(np.bincount(first_corners // 3, minlength=len(triangles)))
+                    num_triangles = np.searchsorted(vertex_counts, limit - 3) + 1
+                    chunk = triangles[:num_triangles]
+                    triangles = triangles[num_triangles:]
+                    chunk = chunk.ravel()
+                    first_corners, new_indices = unique_in_order(chunk)
+                    new_meshes.append(Mesh(mesh.material_id, mesh.vertices[chunk[first_corners]], new_indices))
             else:
                 new_meshes.append(mesh)
         return new_meshes
 
-    def _calculate_uvs(self, obj, mesh, material_id, co):
-        size = obj.dimensions
-        x = co[0] / size[0]
-        y = co[1] / size[1]
+    def _calculate_uvs(self, obj, mesh, material_id, positions):
+        size = obj.dimensions[:2]
+        if not all(size):
+            raise Exception(f"Object '{obj.name}' has no UV map and no size along X or Y to generate one")
+        uvs = positions / size
         mat = mesh.materials[material_id]
         texture_node = get_active_material_texture_slot(mat)
         if texture_node:
-            x *= texture_node.texture_mapping.scale[0]
-            y *= texture_node.texture_mapping.scale[1]
-            x += texture_node.texture_mapping.translation[0]
-            y += texture_node.texture_mapping.translation[1]
-        return (x, y)
+            uvs *= texture_node.texture_mapping.scale[:2]
+            uvs += texture_node.texture_mapping.translation[:2]
+        return uvs
 
 
 class NodeProperties:
+    __slots__ = ("name",) + NODE_SETTINGS
+
     def __init__(self, node):
         ac_node = node.assettoCorsa
         self.name = node.name
@@ -334,29 +316,32 @@ class NodeProperties:
 
 class NodeSettings:
     def __init__(self, settings, node_settings_key):
-        self._settings = settings
-        self._node_settings_key = node_settings_key
-        self._node_name_matches = self._convert_to_matches_list(node_settings_key)
+        self._node_name_regex = self._convert_to_match_regex(node_settings_key)
+        node_settings = settings[NODES][node_settings_key]
+        self.lodIn = node_settings.get("lodIn")
+        self.lodOut = node_settings.get("lodOut")
+        self.layer = node_settings.get("layer")
+        self.castShadows = node_settings.get("castShadows")
+        self.visible = node_settings.get("visible")
+        self.transparent = node_settings.get("transparent")
+        self.renderable = node_settings.get("renderable")
+        self._overrides = [
+            (setting, getattr(self, setting)) for setting in NODE_SETTINGS
+            if getattr(self, setting) is not None
+        ]
 
     def apply_settings_to_node(self, node):
         if not self._does_node_name_match(node.name):
             return
-        for setting in NODE_SETTINGS:
-            setting_val = self._get_node_setting(setting)
-            if setting_val is not None:
-                setattr(node, setting, setting_val)
+        for setting, setting_val in self._overrides:
+            setattr(node, setting, setting_val)
 
     def _does_node_name_match(self, node_name):
-        for regex in self._node_name_matches:
-            if regex.match(node_name):
-                return True
-        return False
+        return self._node_name_regex.match(node_name) is not None
 
-    def _convert_to_matches_list(self, key):
-        matches = []
-        for subkey in key.split("|"):
-            matches.append(re.compile(f"^{self._escape_match_key(subkey)}$", re.IGNORECASE))
-        return matches
+    def _convert_to_match_regex(self, key):
+        subkeys = "|".join(self._escape_match_key(subkey) for subkey in key.split("|"))
+        return re.compile(f"^(?:{subkeys})$", re.IGNORECASE)
 
     def _escape_match_key(self, key):
         wildcard_replacement = "__WILDCARD__"
@@ -365,52 +350,10 @@ class NodeSettings:
         key = key.replace(wildcard_replacement, ".*")
         return key
 
-    def _get_node_setting(self, setting):
-        if setting in self._settings[NODES][self._node_settings_key]:
-            return self._settings[NODES][self._node_settings_key][setting]
-        return None
-
-
-class UvVertex:
-    def __init__(self, co, normal, uv, tangent):
-        self.co = co
-        self.normal = normal
-        self.uv = uv
-        self.tangent = tangent
-        self.hash = None
-
-    def __hash__(self):
-        if not self.hash:
-            self.hash = hash(
-                hash(self.co[0]) ^
-                hash(self.co[1]) ^
-                hash(self.co[2]) ^
-                hash(self.normal[0]) ^
-                hash(self.normal[1]) ^
-                hash(self.normal[2]) ^
-                hash(self.uv[0]) ^
-                hash(self.uv[1]) ^
-                hash(self.tangent[0]) ^
-                hash(self.tangent[1]) ^
-                hash(self.tangent[2])
-            )
-        return self.hash
-
-    def __eq__(self, other):
-        if self.co[0] != other.co[0] or self.co[1] != other.co[1] or self.co[2] != other.co[2]:
-            return False
-        if self.normal[0] != other.normal[0] or self.normal[1] != other.normal[1] or self.normal[2] != other.normal[2]:
-            return False
-        if self.uv[0] != other.uv[0] or self.uv[1] != other.uv[1]:
-            return False
-        if (self.tangent[0] != other.tangent[0]
-                or self.tangent[1] != other.tangent[1]
-                or self.tangent[2] != other.tangent[2]):
-            return False
-        return True
-
 
 class Mesh:
+    __slots__ = ("material_id", "vertices", "indices")
+
     def __init__(self, material_id, vertices, indices):
         self.material_id = material_id
         self.vertices = vertices